@@ -0,0 +1,94 @@
+"""
+Decode throughput of get_events responses: decoding whole responses the
+way the zulip client does, against decode_events.
+
+usage: python3 bench_decode.py [recorded.json ...]
+
+Each recorded file holds the body of one get_events response. Without
+any, a batch is synthesized: mostly chatter that doesn't mention
+coffeebot, as an unnarrowed queue sees it.
+"""
+from timeit import timeit
+import json
+import random
+import sys
+import tracemalloc
+
+from coffeebot.coffeebot import decode_events, orjson
+
+
+def synthesize(n_events=20000, mentioned=0.05):
+    events = []
+    for i in range(n_events):
+        is_mentioned = random.random() < mentioned
+        content = ("@**coffeebot** join" if is_mentioned
+                   else "lorem ipsum dolor sit amet " * random.randint(1, 20))
+        events.append({
+            'type': 'message',
+            'id': i,
+            'flags': ['mentioned'] if is_mentioned else [],
+            'message': {
+                'id': 100000 + i,
+                'type': 'stream',
+                'content': content,
+                'content_type': 'text/x-markdown',
+                'display_recipient': 'coffee',
+                'stream_id': 7,
+                'subject': 'topic {}'.format(i % 50),
+                'topic_links': [],
+                'sender_id': i % 300,
+                'sender_full_name': 'Person {}'.format(i % 300),
+                'sender_email': 'person{}@example.com'.format(i % 300),
+                'sender_realm_str': 'example',
+                'avatar_url': ('https://secure.gravatar.com/avatar/'
+                               '{:032x}?d=identicon&version=1'.format(i)),
+                'client': 'website',
+                'is_me_message': False,
+                'reactions': [],
+                'submessages': [],
+                'recipient_id': 20,
+                'timestamp': 1500000000 + i,
+            },
+        })
+    return json.dumps({'result': 'success', 'msg': '',
+                       'events': events}).encode()
+
+
+def retained(decode, body):
+    """Bytes still allocated while holding on to decode(body)."""
+    tracemalloc.start()
+    result = decode(body)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def main():
+    if sys.argv[1:]:
+        bodies = []
+        for recorded in sys.argv[1:]:
+            with open(recorded, 'rb') as f:
+                bodies.append(f.read())
+    else:
+        random.seed(0)
+        bodies = [synthesize()]
+
+    n_bytes = sum(len(body) for body in bodies)
+    n_events = sum(decode_events(body).received for body in bodies)
+    print("{} events, {:.1f} MB, decoding with {}".format(
+        n_events, n_bytes / 1e6, "orjson" if orjson else "json"))
+
+    for name, decode in (("json.loads", json.loads),
+                         ("decode_events", decode_events)):
+        rounds = 5
+        seconds = timeit(
+            lambda: [decode(body) for body in bodies], number=rounds)
+        memory = sum(retained(decode, body) for body in bodies)
+        print("{:>14}: {:9.0f} events/s {:7.1f} MB/s {:7.1f} MB held".format(
+            name, n_events * rounds / seconds,
+            n_bytes * rounds / seconds / 1e6, memory / 1e6))
+
+
+if __name__ == '__main__':
+    main()
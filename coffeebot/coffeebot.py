@@ -1,14 +1,36 @@
 from datetime import datetime, timedelta
-from collections import namedtuple
+from collections import namedtuple, Counter, OrderedDict
 from pprint import pprint
 from os import path
 import argparse
+import configparser
+import cProfile
+import heapq
+import itertools
+import json
+import pstats
+import queue
 import random
 import re
+import signal
+import tempfile
+import threading
+import time
+import traceback
+import tracemalloc
+import urllib.parse
 
 # external dep
+import requests
 import zulip
 
+# installed with coffeebot where it's supported (python 3.8 and up).
+# older interpreters decode events with json instead.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # ==================== PARSING ====================
 
 # what are we called?
@@ -61,7 +83,7 @@ COMMAND_REGS = (
         ))
 )
 
-HELP_STRING = """
+HELP_TEMPLATE = """
 
 Overview:
 
@@ -79,7 +101,7 @@ Initialize a collective, with you as the leader. The leader currently has no fan
 
 - "@**{0}** yes"
 
-Join an open collective. By joining you affirm you want coffee, and are willing to make coffee for up to 2 others.
+Join an open collective. By joining you affirm you want coffee, and are willing to make coffee for up to {1} others. Reacting :coffee: on {0}'s init message does the same, and taking the reaction back leaves.
 
 - "@**{0}** no"
 
@@ -95,12 +117,14 @@ Ping all those in the collective (this should only be used to signify coffee is
 
 - "@**{0}** state"
 
-Publicly say the state of the collective. This includes the members inside, the time the collective was created, and the approximate time left until the collective timeouts.
+Publicly say the state of the collective. This includes the members inside, the time the collective was created, and the approximate time left until the collective timeouts. The message {0} posts on init is also kept up to date with this.
 
 In the event of multiple commands sent in a single message, {0} will use the first one.
 
 Questions? Bugs? Message @**Ahmad Jarara (S2'17)** or seek the source: https://github.com/alphor/zulip-coffeebot
-""".format(NAME.capitalize())  # noqa: E501
+"""  # noqa: E501
+
+HELP_STRING = HELP_TEMPLATE.format(NAME.capitalize(), 2)
 
 
 # soon enough I should move the default format to a more readable reg
@@ -110,7 +134,7 @@ def reg_wrap(regex, fmt=r"^.*(?![`'\"])@\*\*{}\*\*\s+{}(?![`'\"]).*$",
     Wrap a regex in another, using fmt. Default makes it so
     that any regex quoted does not summon coffeebot, for example demos.
     """
-    return re.compile(fmt.format(name, regex))
+    return re.compile(fmt.format(re.escape(name), regex))
 
 
 # this is populated by the below function.
@@ -134,29 +158,152 @@ def get_parse_map(
       )
     """
     if command_regs not in _parse_cache:
-        out = []
-        for command, raw_reg_tup in command_regs:
-            for raw_reg in raw_reg_tup:
-                out.append(
-                    # wrap the regex in a format and assoc it with command
-                    (reg_wrap(raw_reg), command))
-        _parse_cache[command_regs] = out
+        _parse_cache[command_regs] = compile_parse_map(command_regs)
 
     return _parse_cache[command_regs]
 
 
-def parse(message):
+def compile_parse_map(command_regs, name=NAME):
+    """
+    Build a parse map from scratch, as get_parse_map describes, for
+    coffeebot going by name.
+    """
+    out = []
+    for command, raw_reg_tup in command_regs:
+        for raw_reg in raw_reg_tup:
+            out.append(
+                # wrap the regex in a format and assoc it with command
+                (reg_wrap(raw_reg, name=name), command))
+    return out
+
+
+def parse(message, parse_map=None):
     """
-    Given a message, return the first match obtained from
-    get_parse_map. If no matches are obtained return None.
+    Given a message, return the first match obtained from parse_map
+    (get_parse_map by default). If no matches are obtained return None.
     """
+    if parse_map is None:
+        parse_map = get_parse_map()
     downcased_by_line = message.lower().split(sep="\n")
-    for reg, command in get_parse_map():
+    for reg, command in parse_map:
         for line in downcased_by_line:
             if reg.match(line):
                 return command
 
 
+# how often may one person use a command? each command maps to
+# (uses, seconds): that many uses in a burst, earned back over that many
+# seconds. 'unknown' is for mentions that didn't parse.
+RATE_LIMITS = {
+    'init':    (3, 60),
+    'add':     (5, 60),
+    'remove':  (5, 60),
+    'close':   (5, 60),
+    'ping':    (3, 60),
+    'state':   (3, 60),
+    'love':    (2, 60),
+    'help':    (2, 60),
+    'unknown': (3, 60),
+}
+
+
+# ==================== settings ====================
+
+# everything about coffeebot that can change without a restart, compiled
+# and ready to go. coffeebot holds one of these at a time, and swaps the
+# whole thing on reload.
+Settings = namedtuple("Settings", [
+    'name', 'help_string', 'parse_map', 'max_size', 'timeout_in_mins',
+    'rate_limits'])
+
+
+def make_settings(name=NAME, command_regs=COMMAND_REGS, max_size=3,
+                  timeout_in_mins=20, help_string=None,
+                  rate_limits=RATE_LIMITS):
+    if max_size < 1 or timeout_in_mins < 1:
+        raise ValueError("max_size and timeout_in_mins must be positive")
+    for uses, seconds in rate_limits.values():
+        if uses < 1 or seconds <= 0:
+            raise ValueError("rate limits must be positive")
+    # messages are lowercased before they're parsed.
+    name = name.lower()
+    if help_string is None:
+        help_string = HELP_TEMPLATE.format(name.capitalize(), max_size - 1)
+    return Settings(name, help_string,
+                    compile_parse_map(command_regs, name),
+                    max_size, timeout_in_mins, rate_limits)
+
+
+def parse_rate_limit(limit):
+    """
+    >>> parse_rate_limit("2/60")
+    (2, 60.0)
+    """
+    uses, _, seconds = limit.partition("/")
+    return int(uses), float(seconds)
+
+
+def load_settings(settings_file):
+    """
+    Read settings from an ini file like this one, where anything left
+    out keeps its default:
+
+      [coffeebot]
+      name = coffeebot
+      max_size = 3
+      timeout_in_mins = 20
+
+      [commands]
+      add = yes
+            join
+            in(?!i)
+
+      [rate_limits]
+      love = 1/300
+
+    Each command lists its regexes one per line, replacing the defaults
+    for that command. Rate limits are uses/seconds, as in RATE_LIMITS.
+    Raises ValueError, re.error or configparser.Error
+    if the file doesn't make sense.
+    """
+    # regexes are full of %, so no interpolation.
+    parser = configparser.ConfigParser(interpolation=None)
+    with open(settings_file, encoding="utf-8") as f:
+        parser.read_file(f)
+
+    bot = parser['coffeebot'] if parser.has_section('coffeebot') else {}
+    commands = (parser['commands'] if parser.has_section('commands')
+                else {})
+
+    limits = (parser['rate_limits'] if parser.has_section('rate_limits')
+              else {})
+
+    known = set(command for command, _ in COMMAND_REGS)
+    unknown = ((set(commands) - known) |
+               (set(limits) - set(RATE_LIMITS)))
+    if unknown:
+        raise ValueError("Unknown commands: {}".format(
+            ", ".join(sorted(unknown))))
+
+    rate_limits = dict(RATE_LIMITS)
+    for command in limits:
+        rate_limits[command] = parse_rate_limit(limits[command])
+
+    command_regs = tuple(
+        (command, tuple(line.strip()
+                        for line in commands[command].splitlines()
+                        if line.strip())
+         if command in commands else raw_reg_tup)
+        for command, raw_reg_tup in COMMAND_REGS)
+
+    return make_settings(
+        name=bot.get('name', NAME),
+        command_regs=command_regs,
+        max_size=int(bot.get('max_size', 3)),
+        timeout_in_mins=int(bot.get('timeout_in_mins', 20)),
+        rate_limits=rate_limits)
+
+
 # ==================== Coffeebot primitives ====================
 
 # each action concerning coffeebot has a context. Contexts are simple!
@@ -192,8 +339,6 @@ class Collective():
     Collectives are groups of people interested in making coffee.
     """
     def __init__(self, leader, max_size=3, timeout_in_mins=20):
-        # TODO: Check max_size and timeout_in_mins for reasonable values
-        # when arguments are exposed
         self.leader = leader
         self.max_size = max_size
 
@@ -267,6 +412,555 @@ class Collective():
         return "\n".join(out)
 
 
+def message_link(where, message_id):
+    """
+    A link to the message in its thread, as Zulip writes them.
+
+    >>> message_link(Where('coffee', 'Tea (later)'), 12)
+    '#narrow/stream/coffee/topic/Tea.20.28later.29/near/12'
+    """
+    def encode(part):
+        return urllib.parse.quote(part, safe='').replace(
+            '.', '.2E').replace('%', '.')
+    return "#narrow/stream/{}/topic/{}/near/{}".format(
+        encode(where.stream), encode(where.subject), message_id)
+
+
+class StatusMessage():
+    """
+    The message a collective keeps up to date with its state, edited in
+    place rather than posted anew.
+    """
+    def __init__(self, message_id, header, content):
+        self.message_id = message_id
+        # what precedes the state of the collective
+        self.header = header
+        # as last sent, so unchanged state never costs an edit
+        self.content = content
+        self.last_edit = time.monotonic()
+        # those who joined by reacting :coffee:, and so may leave by
+        # taking it back.
+        self.reaction_joiners = set()
+
+
+# ==================== backpressure ====================
+
+# how urgent is an event, given what coffeebot would do with it? lower
+# is more urgent. heartbeats carry timeout closes, so they go first,
+# while love is the first thing to go under pressure.
+PRIORITIES = {
+    'heartbeat': 0,
+    'init':      1,
+    'add':       1,
+    'remove':    1,
+    'close':     1,
+    'ping':      1,
+    'admin':     1,
+    'state':     2,
+    # mentioned, but not understood. we still owe them a hint.
+    'unknown':   3,
+    'help':      4,
+    'love':      5,
+}
+
+
+class Backlog():
+    """
+    A bounded intake queue for events, popped in priority order (and in
+    arrival order within a priority).
+
+    When full, the least urgent event is shed: either the incoming one,
+    or the least urgent already queued. Events with a merge key collapse
+    into an identical pending one, since answering both says the same
+    thing twice. Everything shed or merged is tallied by tag in shed.
+    """
+    def __init__(self, max_size=100):
+        self.max_size = max_size
+        self.shed = Counter()
+
+        self._heap = []
+        self._seq = itertools.count()
+        self._pending = set()
+
+    def push(self, event, tag, key=None):
+        """
+        Queue event under tag (a key of PRIORITIES). Returns whether
+        the event was queued.
+        """
+        if key is not None and key in self._pending:
+            self.shed[tag] += 1
+            return False
+
+        # seq is unique, so comparisons never reach the event itself.
+        entry = (PRIORITIES[tag], next(self._seq), tag, key, event)
+        if len(self._heap) >= self.max_size:
+            worst = max(self._heap)
+            if worst < entry:
+                self.shed[tag] += 1
+                return False
+            self._heap.remove(worst)
+            heapq.heapify(self._heap)
+            self._forget(worst)
+            self.shed[worst[2]] += 1
+
+        heapq.heappush(self._heap, entry)
+        if key is not None:
+            self._pending.add(key)
+        return True
+
+    def pop(self):
+        """
+        Return the most urgent event, and the tag it was queued under.
+        """
+        entry = heapq.heappop(self._heap)
+        self._forget(entry)
+        return entry[4], entry[2]
+
+    def _forget(self, entry):
+        key = entry[3]
+        if key is not None:
+            self._pending.discard(key)
+
+    def __len__(self):
+        return len(self._heap)
+
+
+# Zulip ANDs the terms of a narrow, so commands (mentions) and help
+# requests (private messages) each get their own event queue.
+REGISTRATIONS = (
+    {'event_types': ['heartbeat', 'message', 'reaction'],
+     'narrow': [['is', 'mentioned']]},
+    {'event_types': ['message'],
+     'narrow': [['is', 'private']]},
+)
+
+# what everyone gets without narrowing, for comparison.
+UNNARROWED_REGISTRATIONS = (
+    {'event_types': ['heartbeat', 'message', 'reaction']},
+)
+
+# Zulip has no way to pick the fields of an event, but it can leave out
+# what coffeebot never reads: rendered html and avatar urls.
+REGISTRATION_DEFAULTS = {
+    'apply_markdown': False,
+    'client_gravatar': True,
+}
+
+
+# ==================== event decoding ====================
+
+# dispatch and its handlers index events like the dicts Zulip sends.
+# these records answer the same way, but only hold what coffeebot reads.
+class Record():
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for field, value in zip(self.__slots__, values):
+            setattr(self, field, value)
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.__slots__ else default
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, ", ".join(
+            "{}={!r}".format(field, getattr(self, field))
+            for field in self.__slots__))
+
+
+class EventRecord(Record):
+    __slots__ = ('type', 'id', 'message',
+                 # reactions only
+                 'op', 'message_id', 'emoji_name', 'user')
+
+    def __init__(self, type, id, message=None, op=None, message_id=None,
+                 emoji_name=None, user=None):
+        super().__init__(type, id, message, op, message_id, emoji_name, user)
+
+
+class MessageRecord(Record):
+    __slots__ = ('type', 'id', 'content', 'display_recipient', 'subject',
+                 'sender_full_name', 'sender_email', 'is_mentioned')
+
+
+class UserRecord(Record):
+    __slots__ = ('email', 'full_name')
+
+
+# what a poll boiled down to. received counts every event in the
+# response, including those that weren't worth a record.
+Decoded = namedtuple("Decoded", [
+    'response', 'events', 'last_event_id', 'received'])
+
+_loads = orjson.loads if orjson else json.loads
+
+
+def project_event(event):
+    """
+    Make a record of a decoded event, or return None if coffeebot has no
+    use for it, as with stream messages that don't mention coffeebot.
+    """
+    kind = event['type']
+    if kind == 'message':
+        message = event['message']
+        is_mentioned = bool(message.get('is_mentioned') or
+                            'mentioned' in event.get('flags', ()))
+        if message['type'] == 'stream' and not is_mentioned:
+            return None
+        return EventRecord(kind, event['id'], message=MessageRecord(
+            message['type'],
+            message['id'],
+            message['content'],
+            message['display_recipient'],
+            message.get('subject'),
+            message['sender_full_name'],
+            message['sender_email'],
+            is_mentioned))
+    if kind == 'reaction':
+        user = event['user']
+        return EventRecord(
+            kind, event['id'],
+            op=event['op'],
+            message_id=event['message_id'],
+            emoji_name=event['emoji_name'],
+            user=UserRecord(user['email'], user['full_name']))
+    if kind == 'heartbeat':
+        return EventRecord(kind, event['id'])
+
+
+def decode_events(body, status_code=200):
+    """
+    Decode the body of a get_events response into records, with orjson
+    if it's installed. The response is returned without its events.
+    """
+    try:
+        response = _loads(body)
+    except ValueError:
+        response = None
+    if not isinstance(response, dict):
+        return Decoded({'result': 'http-error',
+                        'msg': "Unexpected error from the server",
+                        'status_code': status_code}, [], -1, 0)
+
+    raw_events = response.pop('events', ())
+    events = []
+    last_event_id = -1
+    for event in raw_events:
+        last_event_id = max(last_event_id, int(event['id']))
+        record = project_event(event)
+        if record is not None:
+            events.append(record)
+    return Decoded(response, events, last_event_id, len(raw_events))
+
+
+# ==================== event queues ====================
+
+class ServerError(Exception):
+    """
+    Zulip answered, but not with success. The response is in result.
+    """
+    def __init__(self, result):
+        super().__init__(result.get('msg', result['result']))
+        self.result = result
+
+
+# error codes no amount of reconnecting will fix.
+FATAL_CODES = {
+    'UNAUTHORIZED',
+    'INVALID_API_KEY',
+    'USER_DEACTIVATED',
+    'REALM_DEACTIVATED',
+}
+
+
+def classify_error(error):
+    """
+    What should coffeebot do about error? One of:
+
+    - 'transient': the network or the server hiccuped, reconnect.
+    - 'fatal': the server won't have us, give up.
+    - 'unexpected': probably a bug in coffeebot, tell someone and
+      reconnect anyway.
+    """
+    if isinstance(error, ServerError):
+        if error.result.get('code') in FATAL_CODES:
+            return 'fatal'
+        return 'transient'
+    # newer zulip clients wrap network errors in their own.
+    while error is not None:
+        if isinstance(error, requests.exceptions.RequestException):
+            return 'transient'
+        error = error.__cause__
+    return 'unexpected'
+
+
+def backoff(failures, base_delay=1, max_delay=300):
+    """
+    Seconds to wait after failures consecutive failures: exponential,
+    capped at max_delay, with the upper half jittered so that bots don't
+    all reconnect at once.
+    """
+    delay = min(max_delay, base_delay * 2 ** failures)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class EventQueue():
+    """
+    A Zulip event queue, registered on first poll, and again whenever
+    the server forgets about it.
+    """
+    def __init__(self, client, registration, traffic=None):
+        self.client = client
+        self.registration = dict(REGISTRATION_DEFAULTS, **registration)
+        self.traffic = traffic
+
+        self.queue_id = None
+        self.last_event_id = None
+        self.closed = False
+
+    def register(self):
+        res = self.client.register(**self.registration)
+        if res['result'] != 'success':
+            raise ServerError(res)
+        self.queue_id = res['queue_id']
+        self.last_event_id = res['last_event_id']
+
+    def poll(self):
+        """
+        Long-poll for the next batch of events, or None if the server
+        had nothing to say. Raises ServerError if the server won't give
+        us any.
+        """
+        if self.closed:
+            return None
+        if self.queue_id is None:
+            self.register()
+
+        try:
+            decoded = self.fetch()
+        except requests.exceptions.ReadTimeout:
+            # long-polls are expected to run out now and then. failing
+            # to connect at all is another matter, and is raised.
+            return None
+
+        res = decoded.response
+        if res.get('code') == 'BAD_EVENT_QUEUE_ID':
+            # the server forgot about us, start over.
+            self.queue_id = None
+            time.sleep(1)
+            return None
+        if res['result'] != 'success':
+            raise ServerError(res)
+
+        self.last_event_id = max(self.last_event_id, decoded.last_event_id)
+        return decoded.events
+
+    def close(self):
+        """
+        Stop polling, and let the server know it can forget the queue.
+        The connection may well be gone already, so failing is fine.
+        """
+        self.closed = True
+        queue_id, self.queue_id = self.queue_id, None
+        if queue_id is not None:
+            try:
+                self.client.deregister(queue_id)
+            except requests.exceptions.RequestException:
+                pass
+
+    def fetch(self):
+        """
+        Long-poll the events endpoint with the client's session, but
+        decode the response with decode_events rather than the client.
+        """
+        self.client.ensure_session()
+        response = self.client.session.get(
+            urllib.parse.urljoin(
+                self.client.base_url, zulip.API_VERSTRING + "events"),
+            params={'queue_id': self.queue_id,
+                    'last_event_id': self.last_event_id},
+            timeout=90)
+        decoded = decode_events(response.content, response.status_code)
+        if self.traffic is not None:
+            self.traffic.count(bytes_received=len(response.content),
+                               events_received=decoded.received)
+        return decoded
+
+
+class Traffic():
+    """
+    Running totals of the event traffic coffeebot receives and acts on,
+    to see what narrowing saves. Pollers and the main thread all count
+    here, through count.
+    """
+    def __init__(self):
+        self.started = time.monotonic()
+        self.bytes_received = 0
+        self.events_received = 0
+        self.events_processed = 0
+        # received, but given up on when reconnecting
+        self.events_dropped = 0
+
+        self._lock = threading.Lock()
+
+    def count(self, **totals):
+        with self._lock:
+            for total, n in totals.items():
+                setattr(self, total, getattr(self, total) + n)
+
+    def per_hour(self):
+        hours = max(time.monotonic() - self.started, 1) / 3600
+        return (self.bytes_received / hours,
+                self.events_received / hours,
+                self.events_processed / hours)
+
+    def __repr__(self):
+        return ("Per hour: {:.0f} bytes received, {:.0f} events received, "
+                "{:.0f} events processed").format(*self.per_hour())
+
+
+# ==================== rate limiting ====================
+
+class RateLimiter():
+    """
+    Token buckets, one per sender and command. Only the max_buckets most
+    recently used are kept, so with more than that many senders active
+    at once, an evicted sender starts over with a full bucket.
+    """
+    def __init__(self, max_buckets=1000, clock=time.monotonic):
+        self.max_buckets = max_buckets
+        self.clock = clock
+        self.limited = Counter()
+
+        # (sender, command) -> (tokens, time of last use)
+        self._buckets = OrderedDict()
+
+    def allow(self, sender, command, limit):
+        """
+        Spend one of sender's tokens for command, if they have one.
+        limit is (uses, seconds), see RATE_LIMITS.
+        """
+        uses, seconds = limit
+        now = self.clock()
+        key = (sender, command)
+        tokens, last = self._buckets.pop(key, (uses, now))
+        tokens = min(uses, tokens + (now - last) * uses / seconds)
+
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        else:
+            self.limited[command] += 1
+
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_buckets:
+            self._buckets.popitem(last=False)
+        return allowed
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+# ==================== profiling ====================
+
+class Profiler():
+    """
+    Opt-in profiling of dispatch. Once requested, every dispatch runs
+    under cProfile and tracemalloc traces allocations for window
+    seconds, after which reports are written to out_dir. When inactive
+    the only cost is checking active.
+    """
+    def __init__(self, out_dir, window=60):
+        self.out_dir = out_dir
+        self.window = window
+
+        self.active = False
+        self.requested = False
+
+        self._profile = None
+        self._started = None
+        self._snapshot = None
+        self._collectives_before = None
+        self._owns_tracemalloc = False
+
+    # takes and ignores arguments, so that it can be a signal handler.
+    def request(self, *_):
+        self.requested = True
+
+    def run(self, func, *args):
+        return self._profile.runcall(func, *args)
+
+    def tick(self, collectives):
+        """
+        Start or stop profiling, if due. Returns the path of the report
+        if one was written.
+        """
+        if self.requested:
+            self.requested = False
+            if not self.active:
+                self._start(collectives)
+        elif self.active and time.monotonic() - self._started >= self.window:
+            return self._stop(collectives)
+
+    def _start(self, collectives):
+        self._owns_tracemalloc = not tracemalloc.is_tracing()
+        if self._owns_tracemalloc:
+            tracemalloc.start()
+        self._snapshot = tracemalloc.take_snapshot()
+        self._collectives_before = len(collectives)
+        self._profile = cProfile.Profile()
+        self._started = time.monotonic()
+        self.active = True
+
+    def _stop(self, collectives):
+        self.active = False
+        snapshot = tracemalloc.take_snapshot()
+        if self._owns_tracemalloc:
+            tracemalloc.stop()
+
+        # a report that can't be written is no reason to stop handling
+        # events.
+        try:
+            return self._write(snapshot, collectives)
+        except OSError as e:
+            print("Couldn't write profile: {}".format(e))
+        finally:
+            self._profile = None
+            self._snapshot = None
+
+    def _write(self, snapshot, collectives):
+        base = path.join(self.out_dir, "coffeebot-{:%Y%m%d-%H%M%S}".format(
+            datetime.now()))
+        self._profile.dump_stats(base + ".prof")
+
+        # only allocations made here, which is where collectives live.
+        only_here = [tracemalloc.Filter(True, __file__)]
+        growth = snapshot.filter_traces(only_here).compare_to(
+            self._snapshot.filter_traces(only_here), 'lineno')
+
+        with open(base + ".txt", "w") as report:
+            report.write("Collectives: {} -> {}\n\n".format(
+                self._collectives_before, len(collectives)))
+            report.write("Allocation growth:\n")
+            for stat in growth[:20]:
+                report.write("{}\n".format(stat))
+            report.write("\n")
+            self._profile.create_stats()
+            if self._profile.stats:
+                stats = pstats.Stats(self._profile, stream=report)
+                stats.sort_stats('cumulative').print_stats(30)
+            else:
+                report.write("Nothing was dispatched.\n")
+        return base + ".txt"
+
+
 # ==================== Coffeebot, The ====================
 
 
@@ -276,7 +970,10 @@ class Coffeebot():
     execute them in the correct collective.
     """
     def __init__(self, config=None, name=NAME,
-                 help_string=HELP_STRING):
+                 help_string=None, settings_file=None, backlog_size=100,
+                 status_debounce=5,
+                 admins=(), profile_dir=None, profile_window=60,
+                 narrow=True, max_rate_buckets=1000):
 
         # because public messages are the point of interaction, this is
         # a map from parsed directives to methods.
@@ -293,7 +990,20 @@ class Coffeebot():
             'help':   self.send_help,
         }
 
-        self.help_string = help_string
+        # admins may also privately message these, by name.
+        self.admin_methods = {
+            'profile': self.start_profiling,
+            'reload':  self.reload_settings,
+            'stats':   self.send_stats,
+        }
+        self.admins = set(admins)
+
+        # see reload_settings.
+        self.settings_file = settings_file
+        if settings_file:
+            self.settings = load_settings(settings_file)
+        else:
+            self.settings = make_settings(name=name, help_string=help_string)
 
         if isinstance(config, dict):
             self.client = zulip.Client(**config)
@@ -303,18 +1013,67 @@ class Coffeebot():
         # besides IO, this is the only state in Coffeebot.
         self.collectives = {}
 
+        # events waiting on dispatch. see listen.
+        self.backlog = Backlog(backlog_size)
+
+        # status messages by where, and the wheres whose status may be
+        # stale. edits wait status_debounce seconds since the last one,
+        # so a burst of changes goes out as one edit.
+        self.status = {}
+        self.stale_status = set()
+        # status message ids back to their wheres, for reactions.
+        self.status_index = {}
+        self.status_debounce = status_debounce
+
+        self.profiler = Profiler(
+            profile_dir or tempfile.gettempdir(), profile_window)
+
+        # with narrow, the server only sends what coffeebot acts on.
+        # the checks in dispatch stay regardless.
+        self.narrow = narrow
+        self.traffic = Traffic()
+
+        # limits come from settings, so they reload with them.
+        self.rate_limiter = RateLimiter(max_rate_buckets)
+
+        # see supervise.
+        self.started = time.monotonic()
+        self.last_contact = None
+        self.reconnects = 0
+
+    @property
+    def help_string(self):
+        return self.settings.help_string
+
+    def fill(self, template, *args):
+        """
+        Format template with args, and with coffeebot's current name as
+        {name} (for mentions) and {Name} (for prose).
+        """
+        name = self.settings.name
+        return template.format(*args, name=name, Name=name.capitalize())
+
     # ==================== API ====================
     def public_say(self, content, where):
         """
         >>> isinstance(where, Where)
         True
+
+        Returns the id of the sent message, if there is one.
         """
-        self.client.send_message({
+        res = self.client.send_message({
             "type": "stream",
             "to": where.stream,
             "subject": where.subject,
             "content": content,
         })
+        return res.get('id')
+
+    def edit_message(self, content, message_id):
+        return self.client.update_message({
+            "message_id": message_id,
+            "content": content,
+        })
 
     # we always send a help_string, independent of context.
     def private_say(self, content, event):
@@ -335,13 +1094,118 @@ class Coffeebot():
 
     # ==================== utility ====================
     def is_bot_message(self, event):
-        sender_email = event['message']['sender_email']
+        return self.is_bot_email(event['message']['sender_email'])
+
+    def is_bot_email(self, sender_email):
         # currently all bots have "-bot@" in their email, at least on
         # Recurses realm.  since this is itself a bot, the second
         # condition alone is enough but this is kept in here in the
         # case where this policy differs by realm
         return self.client.email == sender_email or "-bot@" in sender_email
 
+    def allowed(self, event, command):
+        """
+        Whether the sender of event still has room to use command. Those
+        who don't are ignored, rather than told about it.
+        """
+        limit = self.settings.rate_limits.get(command)
+        if limit is None:
+            return True
+        return self.rate_limiter.allow(
+            event['message']['sender_email'], command, limit)
+
+    # ==================== status ====================
+    def post_status(self, header, here):
+        content = "{}\n\n{}".format(header, repr(self.collectives[here]))
+        message_id = self.public_say(content, here)
+        if message_id is not None:
+            self.status[here] = StatusMessage(message_id, header, content)
+            self.status_index[message_id] = here
+
+    def touch_status(self, here):
+        if here in self.status:
+            self.stale_status.add(here)
+
+    def status_due(self):
+        """
+        Seconds until the next stale status may be edited, or None if
+        nothing is stale.
+        """
+        if not self.stale_status:
+            return None
+        earliest = min(self.status[here].last_edit
+                       for here in self.stale_status)
+        return max(0, earliest + self.status_debounce - time.monotonic())
+
+    def flush_status(self):
+        """
+        Edit every stale status message whose debounce has passed. The
+        rest stay stale until a later flush.
+        """
+        now = time.monotonic()
+        for here in list(self.stale_status):
+            if now - self.status[here].last_edit >= self.status_debounce:
+                self.send_status(here)
+
+    def send_status(self, here):
+        """
+        Edit the status message of here now, debounce or not, if its
+        collective has changed since.
+        """
+        self.stale_status.discard(here)
+        status = self.status[here]
+        content = "{}\n\n{}".format(
+            status.header, repr(self.collectives[here]))
+        if content != status.content:
+            res = self.edit_message(content, status.message_id)
+            if res.get('result') == 'success':
+                status.content = content
+                status.last_edit = time.monotonic()
+            else:
+                # e.g. past the realm's edit time limit. retrying
+                # won't help, so stop keeping this one up to date.
+                print("Couldn't edit status message {}: {}".format(
+                    status.message_id, res.get('msg')))
+                self.forget_status(here)
+
+    def forget_status(self, here):
+        status = self.status.pop(here, None)
+        if status is not None:
+            del self.status_index[status.message_id]
+        self.stale_status.discard(here)
+
+    # ==================== membership ====================
+    # shared by the text commands and reactions. callers have already
+    # checked that the collective is open, and whether user is in it.
+    def join(self, user, here):
+        coll = self.collectives[here]
+        coll.add(user)
+        self.touch_status(here)
+        if coll.is_full():
+            coll.close()
+            self.public_say(
+                self.fill(
+                    "This collective has filled up and is now closed. "
+                    "{Name} has chosen {} as the coffee maker.\n\n "
+                    "Once you are done making coffee, ping the members "
+                    "of this collective with \"@**{name}** ping\" "
+                    "in this thread.",
+                    coll.maker),
+                here)
+
+    def leave(self, user, here):
+        coll = self.collectives[here]
+        coll.remove(user)
+        if here in self.status:
+            self.status[here].reaction_joiners.discard(user)
+        self.touch_status(here)
+        if len(coll) == 0:
+            coll.close()
+            self.public_say(
+                ("Since everyone has left this collective, "
+                 "it is now closed."),
+                here)
+
     # ==================== collective interaction ====================
     def init_collective(self, event):
         con = make_context(event)
@@ -351,23 +1215,29 @@ class Coffeebot():
             # ping the user by name? let's not.
             # these are a little too verbose I think.
             self.public_say(
-                ("The collective in this thread is still open. If you'd "
-                 "like, join this one with \"@**coffeebot** yes\" or "
-                 "start your own in some other thread."),
+                self.fill(
+                    "The collective in this thread is still open. If you'd "
+                    "like, join this one with \"@**{name}** yes\" or "
+                    "start your own in some other thread."),
                 here)
         else:
-            new_coll = Collective(con.user)
+            settings = self.settings
+            new_coll = Collective(con.user, settings.max_size,
+                                  settings.timeout_in_mins)
             self.collectives[here] = new_coll
-            self.public_say(
-                ("You've initialized a coffee collective! :tada:\n\n "
-                 "This collective can take {} other members (you can join by "
-                 "typing \"@**coffeebot** yes\" or \"@**coffeebot** join\")."
-                 "\n\nA collective is a group of people who want coffee. When "
-                 "enough people join, the collective closes, selecting "
-                 "someone randomly to make it.\n\n"
-                 "For more usage details, send me a private message or type"
-                 "\"@**coffeebot help**\".").format(
-                     new_coll.max_size - 1),
+            # reactions on the old announcement mean nothing anymore.
+            self.forget_status(here)
+            self.post_status(
+                self.fill(
+                    "You've initialized a coffee collective! :tada:\n\n "
+                    "This collective can take {} other members (you can "
+                    "join by typing \"@**{name}** yes\" or "
+                    "\"@**{name}** join\").\n\nA collective is a group of "
+                    "people who want coffee. When enough people join, the "
+                    "collective closes, selecting someone randomly to make "
+                    "it.\n\nFor more usage details, send me a private "
+                    "message or type \"@**{name}** help\".",
+                    new_coll.max_size - 1),
                 here)
 
     def add_to_collective(self, event):
@@ -378,33 +1248,26 @@ class Coffeebot():
             if coll.closed:
                 self.public_say(
                     # notify user of all open collectives?
-                    ("This collective is closed.  Start your own with "
-                     "\"@**coffeebot** init\" \n\nFor further details, "
-                     "say \"@**coffeebot** help\" or send me a private "
-                     "message."), here)
+                    self.fill(
+                        "This collective is closed.  Start your own with "
+                        "\"@**{name}** init\" \n\nFor further details, "
+                        "say \"@**{name}** help\" or send me a private "
+                        "message."), here)
             elif con.user in coll.users:
                 self.public_say(
-                    ("You're already in this collective. Coffeebot "
-                     "appreciates the enthusiasm, though."),
+                    self.fill(
+                        "You're already in this collective. {Name} "
+                        "appreciates the enthusiasm, though."),
                     here)
             else:
-                coll.add(con.user)
                 self.emoji_reply("thumbs_up", event)
-                if coll.is_full():
-                    coll.close()
-                    self.public_say(
-                        ("This collective has filled up and is now closed. "
-                         "Coffeebot has chosen {} as the coffee maker.\n\n "
-                         "Once you are done making coffee, ping the members "
-                         "of this collective with \"@**coffeebot ping**\" "
-                         "in this thread.").format(
-                             coll.maker),
-                        here)
+                self.join(con.user, here)
         else:
             self.public_say(
-                ("There is no recently active collective in this "
-                 "thread. Make a new one with \"@**coffeebot** init\"! "
-                 "\n\nFor further details, send me a private message."),
+                self.fill(
+                    "There is no recently active collective in this "
+                    "thread. Make a new one with \"@**{name}** init\"! "
+                    "\n\nFor further details, send me a private message."),
                 here)
 
     def remove_from_collective(self, event):
@@ -420,25 +1283,31 @@ class Coffeebot():
                          coll.maker),
                     here)
             elif con.user in coll:
-                coll.remove(con.user)
                 self.emoji_reply("thumbs_up", event)
-                if len(coll) == 0:
-                    coll.close()
-                    self.public_say(
-                        ("Since everyone has left this collective, "
-                         "it is now closed."),
-                        here)
+                self.leave(con.user, here)
 
     def state_of_collective(self, event):
         here = make_where(event)
-        if here in self.collectives:
+        if here in self.stale_status:
+            self.send_status(here)
+        status = self.status.get(here)
+        if status is not None:
+            # the status message already says it all, or will once
+            # edited, so point there rather than say it again.
+            self.public_say(
+                "The state of this collective is kept up to date "
+                "[here]({}).".format(message_link(here, status.message_id)),
+                here)
+        elif here in self.collectives:
             self.public_say(
                 repr(self.collectives[here]),
                 here)
         else:
             self.public_say(
-                ("Coffeebot does not know anything about the collectives "
-                 "in this thread. Coffeebot has no persistent storage. :cry:"),
+                self.fill(
+                    "{Name} does not know anything about the collectives "
+                    "in this thread. {Name} has no persistent storage. "
+                    ":cry:"),
                 here)
 
     def ping_collective(self, event):
@@ -462,8 +1331,9 @@ class Coffeebot():
                 # eh I could see how this could be annoying
                 # if you're in a rush or something.
                 self.public_say(
-                    ("This collective isn't closed yet, "
-                     "so Coffeebot sees no reason to ping it."),
+                    self.fill(
+                        "This collective isn't closed yet, "
+                        "so {Name} sees no reason to ping it."),
                     here)
 
     def close_collective(self, event):
@@ -477,14 +1347,16 @@ class Coffeebot():
                     here)
             elif con.user in coll:
                 coll.close()
+                self.touch_status(here)
                 self.public_say(
-                    ("Coffeebot has deliberated for almost {} μs "
-                     "and has chosen @**{}** as the coffee maker.\n\nOnce you "
-                     "are done making coffee, ping the members of this "
-                     "collective with \"@**coffeebot** ping\" in this "
-                     "thread.").format(
-                         str(random.random())[:6],
-                         coll.maker),
+                    self.fill(
+                        "{Name} has deliberated for almost {} μs "
+                        "and has chosen @**{}** as the coffee maker.\n\n"
+                        "Once you are done making coffee, ping the members "
+                        "of this collective with \"@**{name}** ping\" in "
+                        "this thread.",
+                        str(random.random())[:6],
+                        coll.maker),
                     here)
 
     # you go glenn coco
@@ -509,33 +1381,155 @@ class Coffeebot():
     def send_help(self, event):
         self.private_say(self.help_string, event)
 
+    # ==================== administration ====================
+    def admin_command(self, event):
+        """
+        Return the admin command in event, if it is a private message
+        from an admin consisting of one.
+        """
+        message = event['message']
+        if message['sender_email'] in self.admins:
+            command = message['content'].strip().lower()
+            if command in self.admin_methods:
+                return command
+
+    def reload_settings(self, event=None):
+        """
+        Compile settings_file in the background and swap it in once it's
+        ready. Until then events are handled with the current settings,
+        and if the file is broken they stay. Returns the thread doing it.
+        """
+        def compile_and_swap():
+            if not self.settings_file:
+                outcome = "There is no settings file to reload."
+            else:
+                try:
+                    settings = load_settings(self.settings_file)
+                except (OSError, ValueError, re.error,
+                        configparser.Error) as e:
+                    outcome = "Couldn't reload {}: {}".format(
+                        self.settings_file, e)
+                else:
+                    self.settings = settings
+                    outcome = "Reloaded {}.".format(self.settings_file)
+            print(outcome)
+            if event is not None:
+                self.private_say(outcome, event)
+
+        reloader = threading.Thread(target=compile_and_swap, daemon=True)
+        reloader.start()
+        return reloader
+
+    def send_stats(self, event):
+        self.private_say(self.stats(), event)
+
+    def stats(self):
+        def tally(counter):
+            return ", ".join("{} {}".format(count, tag) for tag, count
+                             in sorted(counter.items())) or "nothing"
+
+        return ("Up for {}, reconnected {} times, dropping {} events.\n"
+                "{}\nShed: {}\nRate limited: {}").format(
+            self.uptime(), self.reconnects, self.traffic.events_dropped,
+            repr(self.traffic), tally(self.backlog.shed),
+            tally(self.rate_limiter.limited))
+
+    def uptime(self):
+        return timedelta(seconds=int(time.monotonic() - self.started))
+
+    def report_error(self, error):
+        """
+        Tell the admins about an error they'll want to look into.
+        """
+        for admin in self.admins:
+            self.client.send_message({
+                "type": "private",
+                "to": admin,
+                "content": "Coffeebot error: {}".format(error)
+            })
+
+    def start_profiling(self, event):
+        if not path.isdir(self.profiler.out_dir):
+            self.private_say(
+                "Not profiling: {} is not a directory.".format(
+                    self.profiler.out_dir),
+                event)
+            return
+        self.profiler.request()
+        self.private_say(
+            "Profiling for {} seconds. Reports will be in {}.".format(
+                self.profiler.window, self.profiler.out_dir),
+            event)
+
     # ==================== dispatch ====================
     def handle_heartbeat(self, beat):
         for here, coll in self.collectives.items():
+            if not coll.closed:
+                # the countdown may have moved on.
+                self.touch_status(here)
             if coll.is_stale() and not coll.closed:
                 # timeout has occured
                 coll.close()
                 self.public_say(
-                    ("This collective has timed out. Coffeebot has chosen "
-                     "@**{}** as the maker.\n\nOnce you are done making "
-                     "coffee, ping the members of this collective "
-                     "with \"@**coffeebot ping**\"").format(coll.maker),
+                    self.fill(
+                        "This collective has timed out. {Name} has chosen "
+                        "@**{}** as the maker.\n\nOnce you are done making "
+                        "coffee, ping the members of this collective "
+                        "with \"@**{name}** ping\"",
+                        coll.maker),
                     here)
 
+    def handle_reaction(self, event):
+        """
+        Reacting :coffee: on a collective's announcement joins it, and
+        taking the reaction back leaves it, for those who joined that
+        way. Unlike the text commands, coffeebot doesn't reply: the
+        status message says it all.
+        """
+        here = self.status_index.get(event['message_id'])
+        if here is None or event['emoji_name'] != 'coffee':
+            return
+        coll = self.collectives[here]
+        if coll.closed:
+            return
+        status = self.status[here]
+        user = event['user']['full_name']
+        if event['op'] == 'add' and user not in coll:
+            status.reaction_joiners.add(user)
+            self.join(user, here)
+        elif (event['op'] == 'remove' and user in coll and
+              user in status.reaction_joiners):
+            self.leave(user, here)
+
     def handle_private_message(self, event):
         """
         For now, pass along the event to private_say, which'll send a
-        help string.
+        help string, unless an admin is asking for something.
 
         Coffeebot doesn't do insider coffee making.
         """
-        self.private_say(self.help_string, event)
+        command = self.admin_command(event)
+        if command:
+            self.admin_methods[command](event)
+        elif self.allowed(event, 'help'):
+            self.private_say(self.help_string, event)
 
-    def handle_public_message(self, event):
+    def handle_public_message(self, event, tag=None):
+        """
+        Run the command in event. tag is what classify made of it, if
+        the event came through the backlog, saving a second parse.
+        """
         message = event['message']
         if 'is_mentioned' in message and message['is_mentioned']:
-            command = parse(message['content'])
+            if tag is None:
+                command = parse(message['content'], self.settings.parse_map)
+            elif tag == 'unknown':
+                command = None
+            else:
+                command = tag
 
+            if not self.allowed(event, command or 'unknown'):
+                return
             if not command:
                 here = make_where(event)
                 self.public_say(
@@ -545,7 +1539,7 @@ class Coffeebot():
             else:
                 self.command_methods[command](event)
 
-    def dispatch(self, event):
+    def dispatch(self, event, tag=None):
         """
         Dispatch event based on its type, sending it to the correct handler.
         """
@@ -554,19 +1548,205 @@ class Coffeebot():
             self.handle_heartbeat(event)
 
         # never reply to thyself, or other bots.
+        elif (switch == 'reaction' and
+              not self.is_bot_email(event['user']['email'])):
+            self.handle_reaction(event)
+
         elif switch == 'message' and not self.is_bot_message(event):
             print("Obtained event: {}".format(event))
             kind = event['message']['type']
             if kind == 'private':
                 self.handle_private_message(event)
             elif kind == 'stream':
-                self.handle_public_message(event)
+                self.handle_public_message(event, tag)
 
-    def listen(self):
-        self.client.call_on_each_event(
-            self.dispatch,
-            # 'reaction' planned but not currently supported
-            event_types=['heartbeat', 'message'])
+    # ==================== intake ====================
+    def classify(self, event):
+        """
+        Return the backlog tag and merge key for event, or None if
+        dispatch would do nothing with it anyway.
+        """
+        switch = event['type']
+        if switch == 'heartbeat':
+            # timeouts are checked on every beat, one pending is enough.
+            return 'heartbeat', ('heartbeat',)
+        if switch == 'reaction':
+            # most reactions are on messages that aren't ours.
+            if (event['message_id'] not in self.status_index or
+                    self.is_bot_email(event['user']['email'])):
+                return None
+            return ('add' if event['op'] == 'add' else 'remove'), None
+        if switch != 'message' or self.is_bot_message(event):
+            return None
+
+        message = event['message']
+        if message['type'] == 'private':
+            if self.admin_command(event):
+                return 'admin', None
+            return 'help', ('help', message['sender_email'])
+        if message['type'] != 'stream' or not message.get('is_mentioned'):
+            return None
+
+        command = parse(message['content'], self.settings.parse_map)
+        if command is None:
+            return 'unknown', None
+        if command == 'help':
+            return 'help', ('help', message['sender_email'])
+        if command == 'state':
+            return 'state', ('state', make_where(event))
+        return command, None
+
+    def intake(self, event):
+        classified = self.classify(event)
+        if classified is not None:
+            tag, key = classified
+            self.backlog.push(event, tag, key)
+
+    def receive(self, batches, block=True, timeout=None):
+        """
+        Push every batch waiting in batches through intake, first
+        waiting for one if block. Returns whether there were any.
+        """
+        try:
+            batch = batches.get(block, timeout)
+        except queue.Empty:
+            return False
+        while True:
+            if isinstance(batch, Exception):
+                raise batch
+            self.last_contact = time.monotonic()
+            for event in batch:
+                self.intake(event)
+            try:
+                batch = batches.get_nowait()
+            except queue.Empty:
+                return True
+
+    def drain(self, batches=None):
+        """
+        Dispatch the backlog, most urgent first. Between dispatches,
+        anything newly arrived in batches joins the backlog, so that it
+        can jump ahead of what's left.
+        """
+        profiler = self.profiler
+        while self.backlog:
+            event, tag = self.backlog.pop()
+            if profiler.active:
+                profiler.run(self.dispatch, event, tag)
+            else:
+                self.dispatch(event, tag)
+            self.traffic.count(events_processed=1)
+            if batches is not None:
+                self.receive(batches, block=False)
+        self.flush_status()
+
+        report = profiler.tick(self.collectives)
+        if report:
+            print("Wrote profile: {}".format(report))
+
+    def event_queues(self):
+        registrations = (REGISTRATIONS if self.narrow
+                         else UNNARROWED_REGISTRATIONS)
+        return [EventQueue(self.client, registration, self.traffic)
+                for registration in registrations]
+
+    def listen(self, report_every=3600):
+        """
+        Long-poll every event queue, each in its own thread, and handle
+        their batches here as they come in. Everything that has arrived
+        goes through the backlog before it is dispatched, so under a
+        flood the events that matter are handled first and the rest are
+        shed.
+        """
+        # pollers hand over batches of events, or the error that
+        # stopped them, which is raised here. polls the server didn't
+        # answer aren't handed over, so they don't count as contact.
+        batches = queue.Queue()
+        stop = threading.Event()
+
+        def poll_forever(event_queue):
+            try:
+                while not stop.is_set():
+                    events = event_queue.poll()
+                    if events is None:
+                        continue
+                    if stop.is_set():
+                        self.drop(events)
+                    else:
+                        batches.put(events)
+            except Exception as e:
+                batches.put(e)
+
+        event_queues = self.event_queues()
+        for event_queue in event_queues:
+            threading.Thread(
+                target=poll_forever, args=(event_queue,), daemon=True).start()
+
+        last_report = time.monotonic()
+        try:
+            while True:
+                # held back status edits don't wait on the next event.
+                if self.receive(batches, timeout=self.status_due()):
+                    self.drain(batches)
+                else:
+                    self.flush_status()
+
+                if time.monotonic() - last_report >= report_every:
+                    print(self.stats())
+                    last_report = time.monotonic()
+        finally:
+            stop.set()
+            while not batches.empty():
+                batch = batches.get_nowait()
+                if not isinstance(batch, Exception):
+                    self.drop(batch)
+
+            # deregistering ends the pollers' long-polls, but it may take
+            # a while on a bad connection, so it happens in the background.
+            def close_all():
+                for event_queue in event_queues:
+                    event_queue.close()
+
+            threading.Thread(target=close_all, daemon=True).start()
+
+    def drop(self, events):
+        if events:
+            self.traffic.count(events_dropped=len(events))
+            print("Dropped {} events from an old connection.".format(
+                len(events)))
+
+    def supervise(self, base_delay=1, max_delay=300):
+        """
+        Listen until a fatal error, which is raised. Anything else
+        reconnects, with fresh event queues, after a backoff that grows
+        with every attempt that fails before hearing from the server.
+        Collectives are kept throughout.
+        """
+        failures = 0
+        while True:
+            connected = time.monotonic()
+            try:
+                self.listen()
+            except Exception as e:
+                kind = classify_error(e)
+                if kind == 'fatal':
+                    raise
+                if kind == 'unexpected':
+                    traceback.print_exc()
+                    try:
+                        self.report_error(e)
+                    except Exception:
+                        traceback.print_exc()
+
+                if self.last_contact is not None and (
+                        self.last_contact >= connected):
+                    failures = 0
+                delay = backoff(failures, base_delay, max_delay)
+                failures += 1
+                self.reconnects += 1
+                print("{} error: {}. Reconnecting in {:.1f}s.".format(
+                    kind.capitalize(), e, delay))
+                time.sleep(delay)
 
 
 CANES = (
@@ -604,34 +1784,48 @@ def main():
                         type=str, nargs='?')
     parser.add_argument('--config_file', metavar='zuliprc.conf',
                         type=str, nargs='?')
+    parser.add_argument('--admin', metavar='you@$REALM', type=str,
+                        action='append', default=[])
+    parser.add_argument('--profile_dir', metavar='/tmp', type=str, nargs='?')
+    parser.add_argument('--no_narrow', action='store_true')
+    parser.add_argument('--settings_file', metavar='coffeebot.ini',
+                        type=str, nargs='?')
     args = parser.parse_args()
 
+    options = {
+        'settings_file': args.settings_file,
+        'admins': args.admin,
+        'profile_dir': args.profile_dir,
+        'narrow': not args.no_narrow,
+    }
+
     if args.api_key and args.email and args.site:
         c = Coffeebot(config={
             'api_key': args.api_key,
             'email':   args.email,
             'site':    args.site,
-        })
+        }, **options)
     elif args.api_key or args.email or args.site:
         print(("api_key, email, and site are all mutually required."
                "\n You entered:\n{}").format(pprint(args)))
         exit(1)
     elif args.config_file:
         # string
-        c = Coffeebot(config=args.config_file)
+        c = Coffeebot(config=args.config_file, **options)
     else:
         # default
         here = path.abspath(path.dirname(__file__))
         config_file = path.join(here, "zuliprc.conf")
-        c = Coffeebot(config=config_file)
+        c = Coffeebot(config=config_file, **options)
+
+    # kill -USR1 profiles the running bot, kill -HUP reloads its settings
+    signal.signal(signal.SIGUSR1, c.profiler.request)
+    signal.signal(signal.SIGHUP, lambda *_: c.reload_settings())
     try:
-        c.listen()
-    except Exception as e:
-        c.client.send_message({
-            "type": "private",
-            "to": "ajarara94@gmail.com",
-            "content": "Coffeebot error: {}".format(e)
-        })
+        c.supervise()
+    except ServerError as e:
+        print("Coffeebot can't go on: {}".format(e))
+        exit(1)
 
 
 if __name__ == '__main__':
@@ -29,4 +29,6 @@ setup(
             'coffeebot=coffeebot.coffeebot:main',
             ],
         },
+    # orjson doesn't support the older pythons, which fall back to json.
+    install_requires=['orjson; python_version >= "3.8"'],
     requires=['zulip'])
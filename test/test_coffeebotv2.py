@@ -1,13 +1,25 @@
 from coffeebot.coffeebot import parse, make_where, make_context
 from coffeebot.coffeebot import Where, Context, Collective, Coffeebot
-from coffeebot.coffeebot import NAME
+from coffeebot.coffeebot import NAME, Backlog, EventQueue, Traffic
+from coffeebot.coffeebot import load_settings, ServerError, classify_error
+from coffeebot.coffeebot import backoff, RateLimiter, decode_events
 
 from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+import json
+import queue
+import threading
+import time
 
 from hypothesis import given
 from hypothesis.strategies import from_regex, text
 
 import pytest
+import requests
+import zulip
+
+import coffeebot.coffeebot
 
 def test_correct():
     assert True
@@ -197,3 +209,928 @@ def test_bot_end_to_end(bot):
     bot.dispatch(
         _generate_public_message(
             "@**coffeebot** ping"))
+
+
+# ==================== backpressure ====================
+
+def _generate_stream_message(content, sender_full_name='Coffeenot (S2 \'17)',
+                             sender_email='Coffeenot@fakerealm.com',
+                             stream='bot-test', subject='arbitrary'):
+    event = _generate_public_message(
+        content, sender_full_name, sender_email, stream, subject)
+    event['message']['type'] = 'stream'
+    event['message']['is_mentioned'] = True
+    return event
+
+
+def test_backlog_priority_order():
+    backlog = Backlog()
+    backlog.push('love', 'love')
+    backlog.push('state', 'state')
+    backlog.push('init', 'init')
+    backlog.push('heartbeat', 'heartbeat')
+    assert [backlog.pop()[0] for _ in range(4)] == [
+        'heartbeat', 'init', 'state', 'love']
+
+
+def test_backlog_sheds_least_urgent():
+    backlog = Backlog(max_size=3)
+    for i in range(3):
+        assert backlog.push('love{}'.format(i), 'love')
+    # a close displaces the newest love, more love is dropped outright.
+    assert backlog.push('close', 'close')
+    assert not backlog.push('love3', 'love')
+    assert backlog.shed['love'] == 2
+    assert [backlog.pop()[0] for _ in range(3)] == ['close', 'love0', 'love1']
+
+
+def test_backlog_merges_pending_keys():
+    backlog = Backlog()
+    assert backlog.push('a', 'state', key='here')
+    assert not backlog.push('b', 'state', key='here')
+    assert backlog.shed['state'] == 1
+    assert backlog.pop() == ('a', 'state')
+    # once answered, a new request gets through again.
+    assert backlog.push('c', 'state', key='here')
+
+
+def test_love_flood_keeps_membership(bot):
+    said = []
+    bot.public_say = lambda content, where: said.append(content)
+    bot.emoji_reply = lambda emoji, event: None
+    bot.backlog.max_size = 10
+
+    for _ in range(50):
+        bot.intake(_generate_stream_message("@**coffeebot** love"))
+    bot.intake(_generate_stream_message("@**coffeebot** init"))
+    for i in range(50):
+        bot.intake(_generate_stream_message(
+            "@**coffeebot** state",
+            sender_full_name='spammer', sender_email='spam{}@x.com'.format(i)))
+    bot.intake(_generate_stream_message(
+        "@**coffeebot** join", sender_full_name='Friend'))
+
+    assert bot.backlog.shed['love'] == 43
+    assert bot.backlog.shed['state'] == 49
+    bot.drain()
+
+    here = Where('bot-test', 'arbitrary')
+    assert bot.collectives[here].users == {'Coffeenot (S2 \'17)', 'Friend'}
+    assert said[0].startswith("You've initialized")
+    assert said[1].startswith("Members:")
+
+
+def test_help_flood_is_merged(bot):
+    sent = []
+    bot.private_say = lambda content, event: sent.append(event)
+    for _ in range(20):
+        bot.intake(_generate_private_message('me@x.com', 'help!'))
+        bot.intake(_generate_stream_message(
+            "@**coffeebot** help", sender_email='me@x.com'))
+    bot.intake(_generate_private_message('you@x.com', 'help!'))
+    bot.drain()
+    assert len(sent) == 2
+    assert bot.backlog.shed['help'] == 39
+
+
+def test_bot_messages_skip_backlog(bot):
+    bot.intake(_generate_stream_message(
+        "@**coffeebot** init", sender_email='other-bot@x.com'))
+    assert len(bot.backlog) == 0
+
+
+# ==================== status messages ====================
+
+def _recording_bot(bot):
+    said, edits, emoji = [], [], []
+
+    def public_say(content, where):
+        said.append(content)
+        return len(said)
+
+    def edit_message(content, message_id):
+        edits.append((message_id, content))
+        return {'result': 'success'}
+
+    bot.public_say = public_say
+    bot.edit_message = edit_message
+    bot.emoji_reply = lambda e, event: emoji.append(e)
+    return said, edits, emoji
+
+
+def test_status_edits_are_debounced(bot):
+    said, edits, _ = _recording_bot(bot)
+    bot.status_debounce = 0
+    bot.intake(_generate_stream_message("@**coffeebot** init"))
+    bot.drain()
+    assert "Members: Coffeenot" in said[0]
+    assert not edits
+
+    # a burst of joins and leaves is a single edit
+    for command, user in (('join', 'A'), ('leave', 'A'), ('join', 'B')):
+        bot.dispatch(_generate_stream_message(
+            "@**coffeebot** " + command, sender_full_name=user))
+    bot.drain()
+    assert len(edits) == 1
+    message_id, content = edits[0]
+    assert message_id == 1
+    assert "B" in content and "A," not in content
+
+    # nothing changed, nothing to edit
+    bot.intake(_generate_heartbeat())
+    bot.drain()
+    assert len(edits) == 1
+
+
+def test_rejected_status_edit_stops_tracking(bot, capsys):
+    said, edits, _ = _recording_bot(bot)
+    bot.status_debounce = 0
+    bot.edit_message = lambda content, message_id: {
+        'result': 'error', 'msg': "The time limit for editing this message "
+                                  "has passed"}
+    bot.dispatch(_generate_stream_message("@**coffeebot** init"))
+    here = Where('bot-test', 'arbitrary')
+    assert here in bot.status
+
+    bot.dispatch(_generate_stream_message(
+        "@**coffeebot** join", sender_full_name='A'))
+    bot.drain()
+    assert "time limit" in capsys.readouterr().out
+    assert here not in bot.status
+    assert not bot.status_index and not bot.stale_status
+
+    # not retried
+    bot.dispatch(_generate_stream_message(
+        "@**coffeebot** leave", sender_full_name='A'))
+    bot.drain()
+    assert "time limit" not in capsys.readouterr().out
+
+
+def test_status_edits_wait_for_debounce(bot):
+    said, edits, _ = _recording_bot(bot)
+    bot.status_debounce = 3600
+    bot.intake(_generate_stream_message("@**coffeebot** init"))
+    bot.intake(_generate_stream_message(
+        "@**coffeebot** join", sender_full_name='A'))
+    bot.drain()
+    assert not edits
+    assert bot.stale_status == {Where('bot-test', 'arbitrary')}
+
+    bot.status_debounce = 0
+    bot.drain()
+    assert len(edits) == 1
+    assert not bot.stale_status
+
+
+def test_state_points_to_status(bot):
+    said, edits, emoji = _recording_bot(bot)
+    bot.status_debounce = 3600
+    bot.intake(_generate_stream_message("@**coffeebot** init"))
+    bot.drain()
+    bot.intake(_generate_stream_message(
+        "@**coffeebot** join", sender_full_name='A'))
+    bot.intake(_generate_stream_message("@**coffeebot** state"))
+    bot.drain()
+
+    # the pending edit goes out first, so the status is worth pointing at
+    assert len(edits) == 1 and "A" in edits[0][1]
+    assert len(said) == 2
+    assert "Members:" not in said[1]
+    assert said[1].endswith(
+        "(#narrow/stream/bot-test/topic/arbitrary/near/1).")
+
+
+def test_state_without_status(bot):
+    said, _, _ = _recording_bot(bot)
+    bot.public_say = lambda content, where: said.append(content)
+    bot.dispatch(_generate_stream_message("@**coffeebot** init"))
+    bot.dispatch(_generate_stream_message("@**coffeebot** state"))
+    assert said[1].startswith("Members:")
+
+
+# ==================== reactions ====================
+
+def _generate_reaction(op, message_id, full_name, emoji_name='coffee',
+                       email='reactor@fakerealm.com'):
+    return {
+        "type": "reaction",
+        "op": op,
+        "message_id": message_id,
+        "emoji_name": emoji_name,
+        "user": {
+            "email": email,
+            "full_name": full_name,
+        },
+    }
+
+
+def test_reaction_join_and_leave(bot):
+    said, edits, emoji = _recording_bot(bot)
+    bot.intake(_generate_stream_message("@**coffeebot** init"))
+    bot.drain()
+    here = Where('bot-test', 'arbitrary')
+    assert bot.status_index == {1: here}
+
+    bot.intake(_generate_reaction('add', 1, 'A'))
+    bot.drain()
+    assert 'A' in bot.collectives[here]
+
+    bot.intake(_generate_reaction('remove', 1, 'A'))
+    bot.drain()
+    assert 'A' not in bot.collectives[here]
+    # no replies, only the init message
+    assert len(said) == 1
+    assert not emoji
+
+
+def test_reaction_fills_collective(bot):
+    said, _, _ = _recording_bot(bot)
+    bot.dispatch(_generate_stream_message("@**coffeebot** init"))
+    bot.dispatch(_generate_reaction('add', 1, 'A'))
+    bot.dispatch(_generate_reaction('add', 1, 'B'))
+    here = Where('bot-test', 'arbitrary')
+    assert bot.collectives[here].closed
+    assert said[-1].startswith("This collective has filled up")
+
+    # closed collectives ignore reactions, like text commands do
+    bot.dispatch(_generate_reaction('remove', 1, 'A'))
+    assert 'A' in bot.collectives[here]
+
+
+def test_reactions_ignored_elsewhere(bot):
+    _recording_bot(bot)
+    bot.dispatch(_generate_stream_message("@**coffeebot** init"))
+    bot.intake(_generate_reaction('add', 42, 'A'))
+    bot.intake(_generate_reaction(
+        'add', 1, 'A', email='totally-not-bot@recurse.com'))
+    assert len(bot.backlog) == 0
+
+    bot.dispatch(_generate_reaction('add', 1, 'A', emoji_name='tea'))
+
+
+def test_unreacting_only_undoes_reaction_joins(bot):
+    _recording_bot(bot)
+    bot.dispatch(_generate_stream_message("@**coffeebot** init"))
+    bot.dispatch(_generate_stream_message(
+        "@**coffeebot** join", sender_full_name='A'))
+    here = Where('bot-test', 'arbitrary')
+
+    # the leader and text joiners stay put
+    for user in ('Coffeenot (S2 \'17)', 'A'):
+        bot.dispatch(_generate_reaction('add', 1, user))
+        bot.dispatch(_generate_reaction('remove', 1, user))
+    assert bot.collectives[here].users == {'Coffeenot (S2 \'17)', 'A'}
+    assert not bot.collectives[here].closed
+
+
+def test_text_leave_forgets_reaction_join(bot):
+    _recording_bot(bot)
+    bot.dispatch(_generate_stream_message("@**coffeebot** init"))
+    bot.dispatch(_generate_reaction('add', 1, 'A'))
+    bot.dispatch(_generate_stream_message(
+        "@**coffeebot** leave", sender_full_name='A'))
+    bot.dispatch(_generate_stream_message(
+        "@**coffeebot** join", sender_full_name='A'))
+    bot.dispatch(_generate_reaction('remove', 1, 'A'))
+    assert 'A' in bot.collectives[Where('bot-test', 'arbitrary')]
+
+
+def test_reinit_drops_old_index(bot):
+    _recording_bot(bot)
+    bot.dispatch(_generate_stream_message("@**coffeebot** init"))
+    bot.dispatch(_generate_stream_message("@**coffeebot** close"))
+    bot.dispatch(_generate_stream_message("@**coffeebot** init"))
+    assert list(bot.status_index) == [3]
+
+
+# ==================== profiling ====================
+
+def test_profiling_window(bot, tmp_path):
+    _recording_bot(bot)
+    bot.profiler.out_dir = str(tmp_path)
+    bot.profiler.window = 0
+
+    bot.profiler.request()
+    bot.drain()
+    assert bot.profiler.active
+
+    bot.intake(_generate_stream_message("@**coffeebot** init"))
+    bot.drain()
+    assert not bot.profiler.active
+
+    report = next(tmp_path.glob("*.txt")).read_text()
+    assert "Collectives: 0 -> 1" in report
+    assert "init_collective" in report
+    assert list(tmp_path.glob("*.prof"))
+
+
+def test_profile_unwritable(bot, tmp_path, capsys):
+    _recording_bot(bot)
+    bot.profiler.out_dir = str(tmp_path / "missing")
+    bot.profiler.window = 0
+
+    bot.profiler.request()
+    bot.drain()
+    bot.intake(_generate_stream_message("@**coffeebot** init"))
+    bot.drain()
+    assert not bot.profiler.active
+    assert bot.profiler._profile is None
+    assert "Couldn't write profile" in capsys.readouterr().out
+
+    # and it can go again once there's somewhere to write.
+    bot.profiler.out_dir = str(tmp_path)
+    bot.profiler.request()
+    bot.drain()
+    bot.drain()
+    assert list(tmp_path.glob("*.txt"))
+
+
+def test_profile_admin_command(bot, tmp_path):
+    sent = []
+    bot.private_say = lambda content, event: sent.append(content)
+    bot.admins = {'admin@x.com'}
+
+    bot.intake(_generate_private_message('someone@x.com', 'profile'))
+    bot.drain()
+    assert not bot.profiler.active
+    assert sent == [bot.help_string]
+
+    bot.profiler.out_dir = str(tmp_path / "missing")
+    bot.intake(_generate_private_message('admin@x.com', 'profile'))
+    bot.drain()
+    assert not bot.profiler.active
+    assert sent[1].startswith("Not profiling")
+
+    bot.profiler.out_dir = str(tmp_path)
+    bot.intake(_generate_private_message('admin@x.com', ' Profile '))
+    bot.drain()
+    assert bot.profiler.active
+    assert sent[2].startswith("Profiling for")
+
+    # let it finish, tracemalloc is process-wide.
+    bot.profiler.window = 0
+    bot.drain()
+    assert not bot.profiler.active
+
+
+# ==================== event queues ====================
+
+def test_narrowed_registrations(bot):
+    narrows = [q.registration.get('narrow') for q in bot.event_queues()]
+    assert narrows == [[['is', 'mentioned']], [['is', 'private']]]
+
+    bot.narrow = False
+    narrows = [q.registration.get('narrow') for q in bot.event_queues()]
+    assert narrows == [None]
+
+
+def test_traffic_counts(bot):
+    _recording_bot(bot)
+    bot.traffic.count(bytes_received=100)
+    bot.intake(_generate_stream_message("@**coffeebot** init"))
+    chatter = _generate_stream_message("unrelated chatter")
+    chatter['message']['is_mentioned'] = False
+    bot.intake(chatter)
+    bot.drain()
+    assert bot.traffic.bytes_received == 100
+    assert bot.traffic.events_processed == 1
+    assert repr(bot.traffic).startswith("Per hour: ")
+
+
+# ==================== settings ====================
+
+_SETTINGS = """
+[coffeebot]
+name = Brewbot
+max_size = 2
+
+[commands]
+add = yes
+      in(?!i)
+"""
+
+
+def test_load_settings(tmp_path):
+    settings_file = tmp_path / "coffeebot.ini"
+    settings_file.write_text(_SETTINGS)
+    settings = load_settings(str(settings_file))
+    assert settings.name == 'brewbot'
+    assert settings.max_size == 2
+    assert settings.timeout_in_mins == 20
+    assert "Brewbot organizes collectives" in settings.help_string
+    assert parse("@**brewbot** in", settings.parse_map) == 'add'
+    assert parse("@**brewbot** join", settings.parse_map) is None
+    assert parse("@**brewbot** init", settings.parse_map) == 'init'
+
+
+def test_bot_names_are_taken_literally(tmp_path):
+    settings_file = tmp_path / "coffeebot.ini"
+    settings_file.write_text("[coffeebot]\nname = Coffee (bot)\n")
+    settings = load_settings(str(settings_file))
+    assert parse("@**coffee (bot)** init", settings.parse_map) == 'init'
+
+    settings_file.write_text("[coffeebot]\nname = brew+\n")
+    settings = load_settings(str(settings_file))
+    assert parse("@**brew+** init", settings.parse_map) == 'init'
+    assert parse("@**breww** init", settings.parse_map) is None
+
+
+def test_mixed_case_name():
+    coff = Coffeebot(config=None, name='Brewbot')
+    assert coff.settings.name == 'brewbot'
+    assert parse("@**Brewbot** init", coff.settings.parse_map) is not None
+    assert "Brewbot" in coff.help_string
+
+
+def test_replies_use_settings(bot, tmp_path):
+    said, _, _ = _recording_bot(bot)
+    settings_file = tmp_path / "coffeebot.ini"
+    settings_file.write_text(_SETTINGS)
+    bot.settings = load_settings(str(settings_file))
+    assert "up to 1 others" in bot.help_string
+
+    bot.dispatch(_generate_stream_message("@**brewbot** init"))
+    bot.dispatch(_generate_stream_message(
+        "@**brewbot** yes", sender_full_name='A'))
+    assert "@**brewbot** yes" in said[0]
+    assert "take 1 other members" in said[0]
+    assert said[1].startswith("This collective has filled up")
+    assert "Brewbot has chosen" in said[1]
+    assert not any("coffeebot" in content.lower() for content in said)
+
+
+def test_load_settings_rejects_unknown_commands(tmp_path):
+    settings_file = tmp_path / "coffeebot.ini"
+    settings_file.write_text("[commands]\nbrew = brew\n")
+    with pytest.raises(ValueError):
+        load_settings(str(settings_file))
+
+    # unknown has a rate limit, but no regexes to replace
+    settings_file.write_text("[commands]\nunknown = foo\n")
+    with pytest.raises(ValueError):
+        load_settings(str(settings_file))
+    settings_file.write_text("[rate_limits]\nunknown = 1/60\n")
+    assert load_settings(str(settings_file)).rate_limits['unknown'] == (1, 60)
+
+
+def test_reload_settings(bot, tmp_path):
+    said, _, _ = _recording_bot(bot)
+    sent = []
+    bot.private_say = lambda content, event: sent.append(content)
+    bot.admins = {'admin@x.com'}
+    settings_file = tmp_path / "coffeebot.ini"
+    settings_file.write_text(_SETTINGS)
+    bot.settings_file = str(settings_file)
+
+    bot.dispatch(_generate_stream_message("@**coffeebot** init"))
+    bot.reload_settings(
+        _generate_private_message('admin@x.com', 'reload')).join()
+    assert sent[-1].startswith("Reloaded")
+
+    # existing collectives carry on, new ones use the new settings
+    here = Where('bot-test', 'arbitrary')
+    assert bot.collectives[here].max_size == 3
+    bot.dispatch(_generate_stream_message(
+        "@**brewbot** init", stream='elsewhere'))
+    assert bot.collectives[Where('elsewhere', 'arbitrary')].max_size == 2
+
+    settings_file.write_text("[coffeebot]\nmax_size = lots\n")
+    bot.reload_settings().join()
+    assert bot.settings.name == 'brewbot'
+
+
+# ==================== supervision ====================
+
+def test_classify_error():
+    assert classify_error(requests.exceptions.ConnectionError()) == 'transient'
+    assert classify_error(ServerError(
+        {'result': 'http-error', 'status_code': 502})) == 'transient'
+    assert classify_error(ServerError(
+        {'result': 'error', 'code': 'INVALID_API_KEY'})) == 'fatal'
+    assert classify_error(KeyError('message')) == 'unexpected'
+
+    try:
+        try:
+            raise requests.exceptions.ConnectionError()
+        except requests.exceptions.ConnectionError as e:
+            raise RuntimeError("cannot connect") from e
+    except RuntimeError as wrapped:
+        assert classify_error(wrapped) == 'transient'
+
+
+def test_backoff_grows_and_caps():
+    for failures in range(12):
+        delay = min(300, 2 ** failures)
+        assert delay / 2 <= backoff(failures) <= delay
+
+
+class _FakeZulip(BaseHTTPRequestHandler):
+    """
+    Answers register with a new queue each time, and events from the
+    script of responses: a list of events, a status code to fail with,
+    an error body, seconds to wait before answering with no events, or
+    None to hang up without answering.
+    """
+    def do_POST(self):
+        self.server.registrations += 1
+        length = int(self.headers['Content-Length'])
+        self.server.registered.append(
+            parse_qs(self.rfile.read(length).decode()))
+        self._reply(200, {'result': 'success', 'last_event_id': -1,
+                          'queue_id': str(self.server.registrations)})
+
+    def do_DELETE(self):
+        length = int(self.headers['Content-Length'])
+        self.server.deregistered.append(
+            parse_qs(self.rfile.read(length).decode()))
+        self._reply(200, {'result': 'success'})
+
+    def do_GET(self):
+        if self.path.startswith('/api/v1/server_settings'):
+            self._reply(200, {'result': 'success', 'zulip_version': 'fake'})
+            return
+        step = self.server.script.pop(0)
+        if isinstance(step, float):
+            # a long-poll with nothing to say
+            time.sleep(step)
+            self._reply(200, {'result': 'success', 'events': []})
+        elif step is None:
+            self.close_connection = True
+        elif isinstance(step, dict):
+            self._reply(400, step)
+        elif isinstance(step, int):
+            self._reply(step, {'result': 'error', 'msg': 'oops',
+                               'code': 'INVALID_API_KEY'
+                               if step == 401 else 'BAD_REQUEST'})
+        else:
+            self._reply(200, {'result': 'success', 'events': step})
+
+    def _reply(self, status, body):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def fake_zulip():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _FakeZulip)
+    server.registrations = 0
+    server.registered = []
+    server.deregistered = []
+    server.script = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+
+
+def _fake_config(fake_zulip):
+    return {
+        'email': 'coffeebot-bot@fakerealm.com',
+        'api_key': 'key',
+        'site': 'http://127.0.0.1:{}'.format(fake_zulip.server_port),
+        'retry_on_errors': False,
+    }
+
+
+def _recorded_message(event_id, content, sender='Coffeenot (S2 \'17)'):
+    event = _generate_stream_message(content, sender_full_name=sender)
+    event['id'] = event_id
+    event['message']['id'] = 100 + event_id
+    return event
+
+
+def test_supervise_reconnects(fake_zulip):
+    fake_zulip.script = [
+        [_recorded_message(0, "@**coffeebot** init", 'A')],
+        None,
+        502,
+        [_recorded_message(0, "@**coffeebot** join", 'B')],
+        401,
+    ]
+    bot = Coffeebot(config=_fake_config(fake_zulip), narrow=False)
+    bot.public_say = lambda content, where: None
+    bot.emoji_reply = lambda emoji, event: None
+
+    with pytest.raises(ServerError):
+        bot.supervise(base_delay=0.01)
+
+    assert bot.reconnects == 2
+    assert fake_zulip.registrations == 3
+    here = Where('bot-test', 'arbitrary')
+    assert bot.collectives[here].users == {'A', 'B'}
+    assert bot.stats().startswith("Up for 0:00:0")
+
+
+# ==================== rate limiting ====================
+
+class _Clock():
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_bucket_refills():
+    clock = _Clock()
+    limiter = RateLimiter(clock=clock)
+    assert [limiter.allow('a', 'love', (2, 60)) for _ in range(3)] == [
+        True, True, False]
+    clock.now = 30
+    assert limiter.allow('a', 'love', (2, 60))
+    assert not limiter.allow('a', 'love', (2, 60))
+    # others, and other commands, have their own buckets
+    assert limiter.allow('b', 'love', (2, 60))
+    assert limiter.allow('a', 'state', (2, 60))
+    assert limiter.limited['love'] == 2
+
+
+def test_rate_limiter_memory_is_bounded():
+    limiter = RateLimiter(max_buckets=100)
+    for i in range(10000):
+        limiter.allow('sender{}'.format(i), 'love', (1, 60))
+    assert len(limiter) == 100
+    # the busiest (most recent) senders are the ones remembered
+    assert not limiter.allow('sender9999', 'love', (1, 60))
+    assert limiter.allow('sender0', 'love', (1, 60))
+
+
+def test_flood_from_many_senders(bot):
+    _recording_bot(bot)
+    loved = []
+    bot.command_methods['love'] = loved.append
+    bot.rate_limiter.clock = _Clock()
+    for _ in range(10):
+        for i in range(50):
+            bot.dispatch(_generate_stream_message(
+                "@**coffeebot** love", sender_email='fan{}@x.com'.format(i)))
+    # everyone gets their two, no more
+    assert len(loved) == 100
+    assert bot.rate_limiter.limited['love'] == 400
+
+    # the flood doesn't get in the way of anyone else
+    bot.dispatch(_generate_stream_message(
+        "@**coffeebot** init", sender_email='thirsty@x.com'))
+    assert Where('bot-test', 'arbitrary') in bot.collectives
+
+
+def test_help_is_rate_limited(bot):
+    sent = []
+    bot.private_say = lambda content, event: sent.append(content)
+    for _ in range(5):
+        bot.dispatch(_generate_private_message('me@x.com', 'hi'))
+    assert len(sent) == 2
+
+
+def test_rate_limits_from_settings(bot, tmp_path):
+    settings_file = tmp_path / "coffeebot.ini"
+    settings_file.write_text("[rate_limits]\nstate = 1/600\n")
+    bot.settings = load_settings(str(settings_file))
+    assert bot.settings.rate_limits['state'] == (1, 600)
+    assert bot.settings.rate_limits['love'] == (2, 60)
+
+    said, _, _ = _recording_bot(bot)
+    for _ in range(3):
+        bot.dispatch(_generate_stream_message("@**coffeebot** state"))
+    assert len(said) == 1
+
+
+class _StubQueue():
+    """
+    Stands in for an EventQueue: hands out its batches in turn. A batch
+    that is an exception is raised; the last batch waits for close.
+    """
+    def __init__(self, *batches):
+        self.batches = list(batches)
+        self.closed = threading.Event()
+
+    def poll(self):
+        batch = self.batches.pop(0)
+        if isinstance(batch, Exception):
+            raise batch
+        if not self.batches:
+            self.closed.wait(5)
+        return batch
+
+    def close(self):
+        self.closed.set()
+
+
+def test_listen_cleans_up_old_queues(bot):
+    _recording_bot(bot)
+    failing = _StubQueue(
+        [_recorded_message(0, "@**coffeebot** init")],
+        ServerError({'result': 'error', 'code': 'INVALID_API_KEY'}))
+    # still long-polling when the connection is given up on
+    lingering = _StubQueue(
+        [_recorded_message(1, "@**coffeebot** join", 'A')])
+    bot.event_queues = lambda: [failing, lingering]
+
+    with pytest.raises(ServerError):
+        Coffeebot.listen(bot)
+
+    assert failing.closed.wait(1) and lingering.closed.wait(1)
+    for _ in range(100):
+        if bot.traffic.events_dropped:
+            break
+        time.sleep(0.01)
+    assert bot.traffic.events_dropped == 1
+    assert "dropping 1 events" in bot.stats()
+
+
+def test_event_queue_deregisters(fake_zulip):
+    fake_zulip.script = [[]]
+    client = zulip.Client(**_fake_config(fake_zulip))
+    event_queue = EventQueue(client, {'event_types': ['message']})
+    event_queue.poll()
+    event_queue.close()
+    assert fake_zulip.deregistered == [{'queue_id': ['1']}]
+    # a closed queue doesn't come back
+    assert event_queue.poll() is None
+    assert fake_zulip.registrations == 1
+
+
+def test_event_queue_timeouts(fake_zulip):
+    fake_zulip.script = [[]]
+    client = zulip.Client(**_fake_config(fake_zulip))
+    event_queue = EventQueue(client, {'event_types': ['message']})
+    event_queue.poll()
+
+    def timing_out(error):
+        def fetch():
+            raise error
+        return fetch
+
+    event_queue.fetch = timing_out(requests.exceptions.ReadTimeout())
+    assert event_queue.poll() is None
+    # the server isn't there at all, which is for supervise to handle.
+    event_queue.fetch = timing_out(requests.exceptions.ConnectTimeout())
+    with pytest.raises(requests.exceptions.ConnectTimeout):
+        event_queue.poll()
+
+
+def test_unanswered_polls_are_not_contact(bot):
+    _recording_bot(bot)
+    bot.event_queues = lambda: [_StubQueue(
+        None, None, ServerError({'result': 'error', 'msg': 'down'}))]
+    with pytest.raises(ServerError):
+        Coffeebot.listen(bot)
+    assert bot.last_contact is None
+
+
+def test_event_queue_reregisters(fake_zulip, monkeypatch):
+    monkeypatch.setattr('time.sleep', lambda _: None)
+    fake_zulip.script = [
+        [_recorded_message(0, "@**coffeebot** init"),
+         _recorded_message(1, "@**coffeebot** join")],
+        {'result': 'error', 'code': 'BAD_EVENT_QUEUE_ID', 'msg': 'gone'},
+        [_recorded_message(0, "@**coffeebot** state")],
+    ]
+    client = zulip.Client(**_fake_config(fake_zulip))
+    event_queue = EventQueue(client, {'event_types': ['message']})
+    assert len(event_queue.poll()) == 2
+    assert event_queue.last_event_id == 1
+    assert event_queue.poll() is None
+    assert event_queue.queue_id is None
+    assert len(event_queue.poll()) == 1
+    assert event_queue.queue_id == '2'
+
+
+def test_traffic_counts_only_events(fake_zulip):
+    fake_zulip.script = [
+        [_recorded_message(0, "@**coffeebot** init"),
+         {'type': 'presence', 'id': 1}],
+    ]
+    client = zulip.Client(**_fake_config(fake_zulip))
+    traffic = Traffic()
+    event_queue = EventQueue(client, {'event_types': ['message']}, traffic)
+    event_queue.poll()
+    client.send_message({'type': 'private', 'to': 'x', 'content': 'y'})
+
+    assert traffic.events_received == 2
+    body = json.dumps({'result': 'success', 'events': [
+        _recorded_message(0, "@**coffeebot** init"),
+        {'type': 'presence', 'id': 1}]}).encode()
+    assert traffic.bytes_received == len(body)
+    assert fake_zulip.registered[0]['apply_markdown'] == ['false']
+
+
+# ==================== event decoding ====================
+
+def test_decode_events_projects_records():
+    chatter = _recorded_message(2, "no mention here")
+    chatter['message']['is_mentioned'] = False
+    flagged = _recorded_message(3, "@**coffeebot** ping")
+    del flagged['message']['is_mentioned']
+    flagged['flags'] = ['mentioned']
+    body = json.dumps({'result': 'success', 'events': [
+        _recorded_message(1, "@**coffeebot** init"),
+        chatter,
+        flagged,
+        {'type': 'presence', 'id': 4},
+        {'type': 'heartbeat', 'id': 5},
+    ]}).encode()
+
+    decoded = decode_events(body)
+    assert decoded.response == {'result': 'success'}
+    assert decoded.last_event_id == 5
+    assert decoded.received == 5
+    assert [event['type'] for event in decoded.events] == [
+        'message', 'message', 'heartbeat']
+
+    event = decoded.events[0]
+    assert event['message']['content'].endswith("@**coffeebot** init")
+    assert event['message']['id'] == 101
+    assert 'is_mentioned' in event['message']
+    assert decoded.events[1]['message']['is_mentioned']
+    assert event.get('flags') is None
+    with pytest.raises(KeyError):
+        event['flags']
+
+
+def test_decode_events_bad_body():
+    decoded = decode_events(b"<html>502 Bad Gateway</html>", 502)
+    assert decoded.response['result'] == 'http-error'
+    assert decoded.response['status_code'] == 502
+    assert decoded.events == []
+
+
+def test_records_dispatch_like_dicts(bot):
+    said, _, emoji = _recording_bot(bot)
+    body = json.dumps({'result': 'success', 'events': [
+        _recorded_message(0, "@**coffeebot** init"),
+        _recorded_message(1, "@**coffeebot** join", 'A'),
+    ]}).encode()
+    for event in decode_events(body).events:
+        bot.intake(event)
+    bot.drain()
+    assert bot.collectives[Where('bot-test', 'arbitrary')].users == {
+        'Coffeenot (S2 \'17)', 'A'}
+    assert emoji == ['thumbs_up']
+
+
+def test_urgent_events_jump_ahead_mid_drain(bot):
+    said = []
+    bot.public_say = lambda content, where: said.append(content)
+    bot.emoji_reply = lambda emoji, event: None
+    batches = queue.Queue()
+
+    for _ in range(5):
+        bot.intake(_generate_stream_message("@**coffeebot** state"))
+        bot.intake(_generate_stream_message(
+            "@**coffeebot** love", sender_email='fan@x.com'))
+    # arrives while the first of those is being handled
+    batches.put([_generate_stream_message(
+        "@**coffeebot** init", sender_email='thirsty@x.com')])
+    bot.drain(batches)
+
+    assert said[0].startswith("Coffeebot does not know")
+    assert said[1].startswith("You've initialized")
+
+
+def test_backlog_reuses_parse(bot, monkeypatch):
+    _recording_bot(bot)
+    parsed = []
+    real_parse = coffeebot.coffeebot.parse
+
+    def counting_parse(*args):
+        parsed.append(args)
+        return real_parse(*args)
+
+    monkeypatch.setattr(coffeebot.coffeebot, 'parse', counting_parse)
+    bot.intake(_generate_stream_message("@**coffeebot** init"))
+    bot.intake(_generate_stream_message("@**coffeebot** nonsense"))
+    bot.drain()
+    assert len(parsed) == 2
+    assert Where('bot-test', 'arbitrary') in bot.collectives
+
+
+def test_trailing_status_edit_needs_no_event(fake_zulip):
+    fake_zulip.script = [
+        [_recorded_message(0, "@**coffeebot** init"),
+         _recorded_message(1, "@**coffeebot** join", 'A')],
+        1.0,
+        401,
+    ]
+    bot = Coffeebot(config=_fake_config(fake_zulip), narrow=False,
+                    status_debounce=0.2)
+    _recording_bot(bot)
+    edited_at = []
+
+    def edit_message(content, message_id):
+        edited_at.append(time.monotonic())
+        return {'result': 'success'}
+
+    bot.edit_message = edit_message
+
+    with pytest.raises(ServerError):
+        bot.listen()
+    # sent during the quiet long-poll, not after it
+    assert len(edited_at) == 1
+    assert time.monotonic() - edited_at[0] > 0.5